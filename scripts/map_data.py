@@ -5,11 +5,18 @@ try:
 except ImportError:
     import pickle
 
+from multiprocessing.pool import ThreadPool
+from collections import deque
+import itertools
+
 import rospy
-import overpy
 import shapely.geometry as geometry
-from shapely.ops import linemerge
 import os
+import errno
+import csv
+import gzip
+import hashlib
+import time
 import utm
 import numpy as np
 
@@ -21,13 +28,89 @@ except ImportError:
             rospy.loginfo(desc)
         return iter
 
-from gpxpy import parse as gpxparse
+try:
+    from shapely import points, linestrings, linearrings, polygons
+    SHAPELY_2 = True
+except ImportError:
+    SHAPELY_2 = False
+
+    # Shapely < 2.0 has no vectorized constructors, build the geometries one by one.
+    def points(x, y):
+        return list(map(geometry.Point, zip(x, y)))
+
+    def split_by_indices(coords, indices):
+        starts = np.flatnonzero(np.diff(indices)) + 1
+        return np.split(coords, starts)
+
+    def linestrings(coords, indices):
+        return [geometry.LineString(c) for c in split_by_indices(coords, indices)]
+
+    def linearrings(coords, indices):
+        return [geometry.LinearRing(c) for c in split_by_indices(coords, indices)]
+
+    def polygons(rings):
+        return [geometry.Polygon(r) for r in rings]
 
 from graph_search_params import *
-from way import Way
+from way import Way, FOOTWAY_VALUES
 
 
 OBSTACLE_RADIUS = 2
+ROAD_WIDTH = 7              # In meters. Width of the buffer around road lines.
+FOOTWAY_WIDTH = 3           # In meters. Width of the buffer around footway lines.
+BARRIER_WIDTH = 2           # In meters. Width of the buffer around barrier lines.
+PARSED_CACHE_VERSION = 1    # Bump when the parsing changes, to invalidate cached map data (see MapData.parsed_cache_path).
+# Attributes restored from a cached MapData with the same OSM queries (see MapData.load_parsed_cache).
+PARSED_ATTRIBUTES = ('way_query', 'rel_query', 'node_query', 'osm_ways_data', 'osm_rels_data', 'osm_nodes_data',
+                     'ways', 'way_node_ids', 'roads', 'footways', 'barriers', 'roads_list', 'footways_list', 'barriers_list')
+# Cached OSM data older than this (in seconds) is ignored and queried again, so that OSM edits are picked up.
+OSM_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+OSM_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'osm_cache')
+
+
+def make_overpy_result_picklable(data):
+    '''
+    Remove unpicklable attributes from an overpy query result and all of its elements (modified in place).
+    '''
+    for element in itertools.chain([data], data.nodes, data.ways, data.areas, data.relations):
+        if hasattr(element, '_attribute_modifiers'):
+            element._attribute_modifiers = None
+    return data
+
+
+def ways_to_geometries(coords, lengths, is_area):
+    '''
+    Build a Polygon (areas) or a LineString (other ways) for every way at once.
+
+    Parameters:
+    -----------
+    coords : numpy.ndarray
+        Concatenated UTM coordinates of the nodes of all the ways.
+    lengths : numpy.ndarray
+        Number of nodes of each way.
+    is_area : numpy.ndarray
+        Boolean mask of the ways that are areas.
+
+    Returns:
+    --------
+    geometries : list
+        Geometry of each way, in the order of the ways.
+    '''
+    way_index = np.repeat(np.arange(len(lengths)), lengths)
+    node_is_area = is_area[way_index]
+    area_ids = np.flatnonzero(is_area)
+    line_ids = np.flatnonzero(~is_area)
+
+    geometries = [None] * len(lengths)
+    if len(area_ids):
+        area_index = np.repeat(np.arange(len(area_ids)), lengths[area_ids])
+        for i, geom in zip(area_ids, polygons(linearrings(coords[node_is_area], indices=area_index))):
+            geometries[i] = geom
+    if len(line_ids):
+        line_index = np.repeat(np.arange(len(line_ids)), lengths[line_ids])
+        for i, geom in zip(line_ids, linestrings(coords[~node_is_area], indices=line_index)):
+            geometries[i] = geom
+    return geometries
 
 
 class CoordsData:
@@ -50,11 +133,15 @@ class CoordsData:
         return x_margin, y_margin
 
 class MapData:
-    def __init__(self, coords, coords_type="file", current_robot_position=None, flip=False):
-        self.api = overpy.Overpass(url="https://overpass.kumi.systems/api/interpreter")
+    def __init__(self, coords, coords_type="file", current_robot_position=None, flip=False, cache_dir=OSM_CACHE_DIR):
+        # Created in run_queries, so that overpy is not imported when the map data is loaded from the cache.
+        self.api = None
+        self.cache_dir = cache_dir
+        self.utm_transformer = None
 
         self.coords_type = coords_type
         if coords_type == "file":
+            from gpxpy import parse as gpxparse
             gpx_f = open(coords, 'r')
             gpx_object = gpxparse(gpx_f)
             self.coords_file = coords
@@ -78,31 +165,34 @@ class MapData:
         else:
             self.robot_position_first_point = False
 
-        self.max_x = np.max(self.waypoints[:,0]) + RESERVE
-        self.min_x = np.min(self.waypoints[:,0]) - RESERVE
-        self.max_y = np.max(self.waypoints[:,1]) + RESERVE
-        self.min_y = np.min(self.waypoints[:,1]) - RESERVE
+        self.min_x, self.min_y = self.waypoints.min(axis=0) - RESERVE
+        self.max_x, self.max_y = self.waypoints.max(axis=0) + RESERVE
 
-        self.max_lat = utm.to_latlon(self.max_x + OSM_RECTANGLE_MARGIN, self.max_y + OSM_RECTANGLE_MARGIN, self.zone_number, self.zone_letter)[0]
-        self.max_long = utm.to_latlon(self.max_x + OSM_RECTANGLE_MARGIN, self.max_y + OSM_RECTANGLE_MARGIN, self.zone_number, self.zone_letter)[1]
-        self.min_lat = utm.to_latlon(self.min_x - OSM_RECTANGLE_MARGIN, self.min_y - OSM_RECTANGLE_MARGIN, self.zone_number, self.zone_letter)[0]
-        self.min_long = utm.to_latlon(self.min_x - OSM_RECTANGLE_MARGIN, self.min_y - OSM_RECTANGLE_MARGIN, self.zone_number, self.zone_letter)[1]
+        # Convert both corners of the rectangle in a single (vectorized) call.
+        corners_x = np.array([self.max_x + OSM_RECTANGLE_MARGIN, self.min_x - OSM_RECTANGLE_MARGIN])
+        corners_y = np.array([self.max_y + OSM_RECTANGLE_MARGIN, self.min_y - OSM_RECTANGLE_MARGIN])
+        lats, lons = utm.to_latlon(corners_x, corners_y, self.zone_number, self.zone_letter)
+        self.max_lat, self.min_lat = lats
+        self.max_long, self.min_long = lons
 
         self.coords_data = CoordsData(self.min_long, self.max_long, self.min_lat, self.max_lat)
 
-        self.points = list(map(geometry.Point, zip(self.waypoints[:,0], self.waypoints[:,1])))
+        self.points = list(points(self.waypoints[:,0], self.waypoints[:,1]))
 
         self.points_information = []
-        self.way_node_ids = set() 
+        self.way_node_ids = frozenset()
 
-        self.roads = set()
-        self.footways = set()
-        self.barriers = set()
+        self.roads = []
+        self.footways = []
+        self.barriers = []
 
         self.roads_list = []
         self.footways_list = []
         self.barriers_list = []
 
+        self.indexed_ways = []
+        self.geom_index = None
+
         self.ways = dict()
 
         self.BARRIER_TAGS = self.csv_to_dict(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'parameters/barrier_tags.csv'))
@@ -112,16 +202,29 @@ class MapData:
         self.OBSTACLE_TAGS = self.csv_to_dict(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'parameters/obstacle_tags.csv'))
         self.NOT_OBSTACLE_TAGS = self.csv_to_dict(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'parameters/not_obstacle_tags.csv'))
 
+        # (key, value) pairs for hashed matching of node tags in parse_nodes.
+        self.obstacle_keys = frozenset(self.OBSTACLE_TAGS)
+        self.obstacle_pairs = self.tags_to_pairs(self.OBSTACLE_TAGS)
+        self.obstacle_wildcard_keys = frozenset(key for key, values in self.OBSTACLE_TAGS.items() if '*' in values)
+        self.not_obstacle_pairs = self.tags_to_pairs(self.NOT_OBSTACLE_TAGS)
+
+        self.loaded_from_cache = self.load_parsed_cache()
+
     def csv_to_dict(self, f):
-        arr = np.genfromtxt(f, dtype=str, delimiter=',')
         dic = dict()
-        for row in arr:
-            if row[0] in dic:
-                dic[row[0]].append(row[1])
-            else:
-                dic[row[0]] = [row[1]]
+        with open(f, 'r') as fh:
+            for row in csv.reader(fh):
+                if not row:
+                    continue
+                dic.setdefault(row[0], []).append(row[1])
         return dic
 
+    def tags_to_pairs(self, tags):
+        '''
+        Convert a key:[values] dictionary of tags to a set of (key, value) pairs, wildcards excluded.
+        '''
+        return frozenset((key, value) for key, values in tags.items() for value in values if value != '*')
+
     def waypoints_to_utm(self, waypoints):
         '''
         Convert waypoints obtained from .gpx file from lat/lon (WGS84) to UTM.
@@ -146,6 +249,17 @@ class MapData:
         zone_letter = utm_arr[3]
         return utm_coords, zone_number, zone_letter
 
+    def get_utm_transformer(self):
+        '''
+        pyproj transformer from WGS84 (lon, lat) to the UTM zone of the waypoints, vectorized over numpy arrays.
+        The utm package is still used to find the zone, in waypoints_to_utm.
+        '''
+        if getattr(self, 'utm_transformer', None) is None:
+            from pyproj import Transformer
+            epsg = (32600 if self.zone_letter.upper() >= 'N' else 32700) + self.zone_number
+            self.utm_transformer = Transformer.from_crs(4326, epsg, always_xy=True)
+        return self.utm_transformer
+
     def get_way_query(self):
         return "(way({}, {}, {}, {}); >; ); out;".format(self.min_lat, self.min_long, self.max_lat, self.max_long)
 
@@ -155,160 +269,279 @@ class MapData:
     def get_node_query(self):
         return "(node({}, {}, {}, {}); ); out;".format(self.min_lat, self.min_long, self.max_lat, self.max_long)
 
-    def run_queries(self):
+    def cache_path(self, key, extension):
         '''
-        Obtain data from OSM through their API.
+        Path of the cache file for the given key (None if caching is disabled).
         '''
-        def make_overpy_result_picklable(data):
-            def make_overpy_picklable(data):
-                if hasattr(data, '_attribute_modifiers'):
-                    data._attribute_modifiers = None
-                return data
-            data = make_overpy_picklable(data)
-            for i in range(len(data.nodes)):
-                data.nodes[i] = make_overpy_picklable(data.nodes[i])
-            for i in range(len(data.ways)):
-                data.ways[i] = make_overpy_picklable(data.ways[i])
-            for i in range(len(data.areas)):
-                data.areas[i] = make_overpy_picklable(data.areas[i])
-            for i in range(len(data.relations)):
-                data.relations[i] = make_overpy_picklable(data.relations[i])
-            return data
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + extension)
+
+    def is_cache_fresh(self, path):
+        '''
+        Whether the cache file exists and is younger than OSM_CACHE_MAX_AGE.
+        '''
+        return os.path.isfile(path) and time.time() - os.path.getmtime(path) < OSM_CACHE_MAX_AGE
 
+    def make_cache_dir(self):
+        '''
+        Create the cache directory if it does not exist yet (safe to call from several threads).
+        '''
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def query_cache_path(self, query):
+        '''
+        Path of the file caching the result of the given query (None if caching is disabled).
+        '''
+        return self.cache_path(query, '.pkl.gz')
+
+    def parsed_cache_path(self):
+        '''
+        Path of the file caching the whole parsed map data (None if caching is disabled).
+        The key covers everything the parse depends on: the queries, the tag and width parameters and
+        PARSED_CACHE_VERSION for the parsing code itself.
+        '''
+        tags = [self.BARRIER_TAGS, self.NOT_BARRIER_TAGS, self.ANTI_BARRIER_TAGS, self.OBSTACLE_TAGS, self.NOT_OBSTACLE_TAGS]
+        params = (PARSED_CACHE_VERSION, OBSTACLE_RADIUS, ROAD_WIDTH, FOOTWAY_WIDTH, BARRIER_WIDTH, sorted(FOOTWAY_VALUES))
+        key = repr((self.get_way_query(), self.get_rel_query(), self.get_node_query(), [sorted(t.items()) for t in tags], params))
+        return self.cache_path(key, '.mapdata.gz')
+
+    def load_parsed_cache(self):
+        '''
+        Restore the results of run_queries and run_parse from the cache. Returns True on success.
+        The cached map data contains the OSM query results, so it expires after OSM_CACHE_MAX_AGE as well.
+        '''
+        path = self.parsed_cache_path()
+        if path is None or not self.is_cache_fresh(path):
+            return False
+        try:
+            cached = MapData.load(path)
+            parsed = [(attr, getattr(cached, attr)) for attr in PARSED_ATTRIBUTES]
+        except Exception as e:
+            rospy.logwarn("Error while loading cached map data {}: {}".format(path, e))
+            return False
+        for attr, value in parsed:
+            setattr(self, attr, value)
+        rospy.loginfo("Map data loaded from {}".format(path))
+        return True
+
+    def save_parsed_cache(self):
+        '''
+        Store the parsed map data in the cache, so that the next run with the same queries can skip run_queries and run_parse.
+        '''
+        path = self.parsed_cache_path()
+        if path is None:
+            return
+        try:
+            self.make_cache_dir()
+            self.save(path)
+        except Exception as e:
+            rospy.logwarn("Error while caching map data {}: {}".format(path, e))
+
+    def load_cached_query(self, query):
+        '''
+        Load the result of a query from the on-disk cache. Returns None on a cache miss,
+        including a result older than OSM_CACHE_MAX_AGE.
+        '''
+        path = self.query_cache_path(query)
+        if path is None or not self.is_cache_fresh(path):
+            return None
+        try:
+            with gzip.open(path, 'rb') as fh:
+                return pickle.load(fh)
+        except Exception as e:
+            rospy.logwarn("Error while loading cached query {}: {}".format(path, e))
+            return None
+
+    def save_cached_query(self, query, data):
+        '''
+        Store the (picklable) result of a query in the on-disk cache.
+        '''
+        path = self.query_cache_path(query)
+        if path is None:
+            return
+        try:
+            self.make_cache_dir()
+            with gzip.open(path, 'wb') as fh:
+                pickle.dump(data, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            rospy.logwarn("Error while caching query {}: {}".format(path, e))
+
+    def query_with_retry(self, query, desc=""):
+        '''
+        Run a single OSM query (or load it from the cache), retrying up to three times on failure.
+        Returns None if all the tries failed.
+        '''
         break_time = rospy.Duration(5)
         tries = 1
         while tries < 4 and not rospy.is_shutdown():
-            rospy.loginfo("Running 1/3 OSM query.")
+            rospy.loginfo("Running {}OSM query.".format(desc))
             try:
-                self.way_query = self.get_way_query()
-                osm_ways_data = self.api.query(self.way_query)
-                self.osm_ways_data = make_overpy_result_picklable(osm_ways_data)
-                break
+                data = self.load_cached_query(query)
+                if data is None:
+                    data = make_overpy_result_picklable(self.api.query(query))
+                    self.save_cached_query(query, data)
+                return data
             except Exception as e:
                 rospy.loginfo(e)
                 rospy.loginfo("--------------\nQuery failed.\nRerunning the query after {} s.".format(break_time))
                 rospy.sleep(break_time)
                 tries += 1
+        return None
 
-        tries = 1
-        while tries < 4 and not rospy.is_shutdown():
-            rospy.loginfo("Running 2/3 OSM query.")
+    def run_queries(self):
+        '''
+        Obtain data from OSM through their API. The three queries are independent, so run them concurrently.
+        '''
+        if self.loaded_from_cache:
+            rospy.loginfo("Using cached OSM data.")
+            return
+
+        if self.api is None:
+            import overpy
+            self.api = overpy.Overpass(url="https://overpass.kumi.systems/api/interpreter")
+
+        self.way_query = self.get_way_query()
+        self.rel_query = self.get_rel_query()
+        self.node_query = self.get_node_query()
+        queries = [(self.way_query, "1/3 "), (self.rel_query, "2/3 "), (self.node_query, "3/3 ")]
+
+        if self.cache_dir is not None:
             try:
-                self.rel_query = self.get_rel_query()
-                osm_rels_data = self.api.query(self.rel_query)
-                self.osm_rels_data = make_overpy_result_picklable(osm_rels_data)
-                break
-            except Exception as e:
-                rospy.loginfo(e)
-                rospy.loginfo("--------------\nQuery failed.\nRerunning the query after {} s.".format(break_time))
-                rospy.sleep(break_time)
-                tries += 1
+                self.make_cache_dir()
+            except OSError as e:
+                rospy.logwarn("Error while creating cache directory {}: {}".format(self.cache_dir, e))
 
-        tries = 1
-        while tries < 4 and not rospy.is_shutdown():
-            rospy.loginfo("Running 3/3 OSM query.")
-            try:  
-                self.node_query = self.get_node_query()
-                osm_nodes_data = self.api.query(self.node_query)
-                self.osm_nodes_data = make_overpy_result_picklable(osm_nodes_data)
-                break
-            except Exception as e:
-                rospy.loginfo(e)
-                rospy.loginfo("--------------\nQuery failed.\nRerunning the query after {} s.".format(break_time))
-                rospy.sleep(break_time)
-                tries += 1
+        pool = ThreadPool(len(queries))
+        try:
+            results = pool.map(lambda q: self.query_with_retry(*q), queries)
+        finally:
+            pool.close()
+            pool.join()
+        self.osm_ways_data, self.osm_rels_data, self.osm_nodes_data = results
 
         rospy.loginfo("Queries finished.")
 
     def combine_ways(self, ids):
         '''
         Combine ways that share a node.
+        Non-area ways are indexed by the ids of their end nodes, so each way is chained to its neighbors
+        through a dictionary lookup instead of being compared with every other way.
         '''
-        ways = []
+        # End node ids of the non-area ways, read once so that chaining only compares integers.
+        heads = dict()
+        tails = dict()
+        ends = dict()
         for id in ids:
-            ways.append(self.ways[id])
-        i = 0
-        while i < len(ways):
-            j = 0
-            while j < len(ways):
-                if i != j and (not ways[i].is_area and not ways[j].is_area):
-                    if (ways[i].nodes[0].id == ways[j].nodes[0].id):
-                        ways[i].nodes.reverse()
-                    elif (ways[i].nodes[-1].id == ways[j].nodes[-1].id):
-                        ways[j].nodes.reverse()
-
-                    if ways[i].nodes[-1].id == ways[j].nodes[0].id:
-                        combined_line = linemerge([ways[i].line, ways[j].line])
-
-                        new_way = Way()
-                        new_way.id = int(-10**15*np.random.random())
-                        while new_way.id in self.ways.keys():
-                            new_way.id = int(-10**15*np.random.random())
-                        # TODO: tady zlobi ten update, podivat se na prirazovani id
-                        new_way.nodes = ways[i].nodes + ways[j].nodes[1:] 
-
-                        if ways[i].tags is None:
-                            ways[i].tags = dict()
-                        if ways[j].tags is None:
-                            ways[j].tags = dict()
-                        new_way.tags = ways[i].tags.update(ways[j].tags)
-                        new_way.line = combined_line
-  
-                        if new_way.nodes[0].id == new_way.nodes[-1].id:
-                            new_way.is_area = True
-                            new_way.line = geometry.Polygon(new_way.line.coords)
-                        self.ways[new_way.id] = new_way
-                        ways[j] = new_way
-                        ids[j] = new_way.id
-                        ids.pop(i)
-                        ways.pop(i)
-                        i -= 1
-                        j -= 1
-                        break
-                j += 1
-            i += 1
-
-        return ids
+            way = self.ways[id]
+            if not way.is_area:
+                heads[id] = way.nodes[0].id
+                tails[id] = way.nodes[-1].id
+                ends.setdefault(heads[id], []).append(id)
+                ends.setdefault(tails[id], []).append(id)
+
+        used = set()
+
+        def pop_neighbor(node_id):
+            for id in ends.get(node_id, []):
+                if id not in used:
+                    used.add(id)
+                    return id
+            return None
+
+        combined_ids = []
+        for id in ids:
+            if id in used:
+                continue
+            used.add(id)
+            if id not in heads:
+                combined_ids.append(id)
+                continue
+
+            # Plan the chain as (way id, reversed) pairs, growing it from the last node forward, then from the first node backward.
+            chain = deque([(id, False)])
+            first_id, last_id = heads[id], tails[id]
+            while first_id != last_id:
+                neighbor = pop_neighbor(last_id)
+                if neighbor is None:
+                    break
+                reverse = heads[neighbor] != last_id
+                chain.append((neighbor, reverse))
+                last_id = heads[neighbor] if reverse else tails[neighbor]
+            while first_id != last_id:
+                neighbor = pop_neighbor(first_id)
+                if neighbor is None:
+                    break
+                reverse = tails[neighbor] != first_id
+                chain.appendleft((neighbor, reverse))
+                first_id = tails[neighbor] if reverse else heads[neighbor]
+
+            if len(chain) == 1:
+                combined_ids.append(id)
+                continue
+
+            # Execute the plan.
+            chain_ways = [self.ways[way_id] for way_id, _ in chain]
+            new_way = Way()
+            new_way.id = int(-10**15*np.random.random())
+            while new_way.id in self.ways.keys():
+                new_way.id = int(-10**15*np.random.random())
+            # The lines are concatenated in the planned order and orientation (linemerge would split
+            # a ring touching itself in a node into a MultiLineString).
+            new_way.nodes = []
+            coords = []
+            for i, (way, (_, reverse)) in enumerate(zip(chain_ways, chain)):
+                nodes = way.nodes[::-1] if reverse else way.nodes
+                line_coords = list(way.line.coords)
+                if reverse:
+                    line_coords.reverse()
+                new_way.nodes.extend(nodes if i == 0 else nodes[1:])
+                coords.extend(line_coords if i == 0 else line_coords[1:])
+                new_way.tags.update(way.tags)
+
+            if first_id == last_id:
+                new_way.is_area = True
+                new_way.line = geometry.Polygon(coords)
+            else:
+                new_way.line = geometry.LineString(coords)
+            self.ways[new_way.id] = new_way
+            combined_ids.append(new_way.id)
+
+        return combined_ids
 
     def parse_ways(self):
         '''
         Fill self.ways, a dictionary of id:way pairs, from all the ways from the query.
         '''
-        for way in tqdm(self.osm_ways_data.ways, desc="Parse ways"):
-            way_to_store = Way()
-            coords = []
+        ways = self.osm_ways_data.ways
+        if not ways:
+            return
 
-            # Convert WGS -> UTM.
-            lats = np.array([float(node.lat) for node in way.nodes])
-            lons = np.array([float(node.lon) for node in way.nodes])
-            utm_coords = utm.from_latlon(lats, lons)
-            coords = list(zip(utm_coords[0], utm_coords[1]))
+        # overpy rebuilds the node list of a way on every access, so read it only once per way.
+        way_nodes = [way.nodes for way in ways]
 
-            # Keep track of IDs of each node, so that in parse_nodes we can distinguish them from solitary nodes.
-            ids = [node.id for node in way.nodes]
-            if self.way_node_ids is None:
-                self.way_node_ids = dict()
-            self.way_node_ids.update(ids)              
-
-            # Distinguish areas and non-areas (we use a single class for both cases).
-            if coords[0] == coords[-1]:
-                way_to_store.is_area = True
-            else:
-                way_to_store.is_area = False
+        # Convert WGS -> UTM for the nodes of all the ways at once, then slice the result per way.
+        offsets = np.cumsum([0] + [len(nodes) for nodes in way_nodes])
+        lats = np.fromiter((float(node.lat) for nodes in way_nodes for node in nodes), dtype=np.float64, count=offsets[-1])
+        lons = np.fromiter((float(node.lon) for nodes in way_nodes for node in nodes), dtype=np.float64, count=offsets[-1])
+        eastings, northings = self.get_utm_transformer().transform(lons, lats)
 
-            way_to_store.id = way.id
-            way_to_store.nodes = way.nodes
-            way_to_store.tags = way.tags
+        # Distinguish areas and non-areas (we use a single class for both cases). OSM ways are closed iff they start and end in the same node.
+        is_area = np.array([nodes[0].id == nodes[-1].id for nodes in way_nodes], dtype=bool)
+        lines = ways_to_geometries(np.column_stack((eastings, northings)), np.diff(offsets), is_area)
 
-            if way_to_store.tags is None:
-                way_to_store.tags = dict()
+        way_node_ids = []
+        for i, way in enumerate(tqdm(ways, desc="Parse ways")):
+            # Keep track of IDs of each node, so that in parse_nodes we can distinguish them from solitary nodes.
+            way_node_ids.extend(node.id for node in way_nodes[i])
 
-            if way_to_store.is_area:
-                way_to_store.line = geometry.Polygon(coords)
-            else:
-                way_to_store.line = geometry.LineString(coords)
+            self.ways[way.id] = Way(id=way.id, is_area=bool(is_area[i]), nodes=way_nodes[i], tags=way.tags, line=lines[i])
 
-            self.ways[way.id] = way_to_store
+        self.way_node_ids = frozenset(way_node_ids)
 
     def parse_rels(self):
         '''
@@ -316,18 +549,11 @@ class MapData:
         Use relations to alter ways - combine neighbor ways, add tags...
         '''
         for rel in tqdm(self.osm_rels_data.relations, desc="Parse rels"):
-            inner_ids = []
-            outer_ids = []
-            keys = self.ways.keys()
-
             # Separate inner and outer ways of relation.
-            for member in rel.members:
-                if member._type_value == "way":
-                    if int(member.ref) in keys:
-                        if member.role == "outer":
-                            outer_ids.append(int(member.ref))
-                        else:
-                            inner_ids.append(int(member.ref))
+            members = [(member.role, int(member.ref)) for member in rel.members if member._type_value == "way"]
+            members = [(role, id) for role, id in members if id in self.ways]
+            outer_ids = [id for role, id in members if role == "outer"]
+            inner_ids = [id for role, id in members if role != "outer"]
 
             # If two ways are "connected" (they share a node), combine them into one.
             outer_ids = self.combine_ways(outer_ids)
@@ -335,19 +561,10 @@ class MapData:
             for id in outer_ids:
                 way = self.ways[id]
                 way.in_out = "outer"
-
-                if way.tags is None:
-                    way.tags = dict()
-                if rel.tags is None:
-                    rel.tags = dict()
                 way.tags.update(rel.tags)
 
-                self.ways[id] = way
-
             for id in inner_ids:
-                way = self.ways[id]
-                way.in_out = "inner"
-                self.ways[id] = way
+                self.ways[id].in_out = "inner"
 
     def parse_nodes(self):
         '''
@@ -355,18 +572,19 @@ class MapData:
         '''
         for node in tqdm(self.osm_nodes_data.nodes, desc="Parse nodes"):
             if not node.id in self.way_node_ids:
-                # Check if node is a obstacle.
-                if any(key in self.OBSTACLE_TAGS and (node.tags[key] in self.OBSTACLE_TAGS[key] or ('*' in self.OBSTACLE_TAGS[key] and not node.tags[key]  in self.NOT_OBSTACLE_TAGS.get(key,[]))) for key in node.tags):
+                # Check if node is a obstacle. Most nodes have no obstacle key at all, so only the matching keys are checked.
+                matching_keys = self.obstacle_keys.intersection(node.tags)
+                if matching_keys and any((key, node.tags[key]) in self.obstacle_pairs or (key in self.obstacle_wildcard_keys and not (key, node.tags[key]) in self.not_obstacle_pairs) for key in matching_keys):
                     obstacle = Way()
                     obstacle.id = node.id
                     obstacle.is_area = True
                     obstacle.tags = node.tags
 
-                    coords = utm.from_latlon(float(node.lat), float(node.lon))
+                    coords = self.get_utm_transformer().transform(float(node.lon), float(node.lat))
                     polygon = self.point_to_polygon(geometry.Point([coords[0], coords[1]]), OBSTACLE_RADIUS)
                     obstacle.line = polygon
 
-                    self.barriers.add(obstacle)
+                    self.barriers.append(obstacle)
 
     def point_to_polygon(self, point, r=1):
         '''
@@ -388,30 +606,69 @@ class MapData:
         '''
         for way in tqdm(self.ways.values(), desc="Separate ways"):
             if way.is_road():
-                way = self.line_to_polygon(way, width=7)
-                self.roads.add(way)
+                way = self.line_to_polygon(way, width=ROAD_WIDTH)
+                self.roads.append(way)
 
             elif way.is_footway():
-                way = self.line_to_polygon(way, width=3)
-                self.footways.add(way)
+                way = self.line_to_polygon(way, width=FOOTWAY_WIDTH)
+                self.footways.append(way)
 
             elif way.is_barrier(self.BARRIER_TAGS, self.NOT_BARRIER_TAGS, self.ANTI_BARRIER_TAGS):
                 if not way.is_area:
-                    way = self.line_to_polygon(way, width=2)
-                self.barriers.add(way)
+                    way = self.line_to_polygon(way, width=BARRIER_WIDTH)
+                self.barriers.append(way)
 
     def sets_to_lists(self):
         '''
-        Convert sets of parsed osm ways into lists.
+        Copy the parsed osm ways into the *_list attributes.
         '''
         self.roads_list = list(self.roads)
         self.footways_list  = list(self.footways)
         self.barriers_list  = list(self.barriers)
 
+    def build_geom_index(self):
+        '''
+        Build a spatial index (STRtree) over the geometries of all roads, footways and barriers.
+        '''
+        from shapely.strtree import STRtree
+
+        self.indexed_ways = self.roads_list + self.footways_list + self.barriers_list
+        self.geom_index = STRtree([way.line for way in self.indexed_ways])
+        if not SHAPELY_2:
+            # Shapely < 2.0 returns the candidate geometries instead of their indices.
+            self.indexed_way_of_line = dict((id(way.line), way) for way in self.indexed_ways)
+
+    def query_ways(self, geom):
+        '''
+        Return all roads, footways and barriers intersecting the given geometry.
+        The spatial index gives the candidates (bounding box hits), which are then tested exactly with
+        their prepared geometries, kept on the ways for the following queries.
+        '''
+        if getattr(self, 'geom_index', None) is None:
+            self.build_geom_index()
+        if SHAPELY_2:
+            candidates = [self.indexed_ways[i] for i in self.geom_index.query(geom)]
+        else:
+            candidates = [self.indexed_way_of_line[id(line)] for line in self.geom_index.query(geom)]
+        return [way for way in candidates if way.get_prepared_line().intersects(geom)]
+
+    def __getstate__(self):
+        # The STRtree is not picklable in older Shapely versions, it is rebuilt on demand after loading.
+        # The API client and the UTM transformer are created again when needed.
+        state = self.__dict__.copy()
+        state['geom_index'] = None
+        state['api'] = None
+        state['utm_transformer'] = None
+        return state
+
     def run_parse(self):
         '''
         Parse OSM data into their respective categories.
         '''
+        if self.loaded_from_cache:
+            rospy.loginfo("Using cached analysis.")
+            return
+
         rospy.loginfo("Running analysis.")
         self.parse_ways()
         self.parse_rels()
@@ -419,6 +676,9 @@ class MapData:
 
         self.separate_ways()
         self.sets_to_lists()
+        # The spatial index is built by query_ways when first needed.
+        self.geom_index = None
+        self.save_parsed_cache()
         rospy.loginfo("Analysis finished.")
 
     def save_to_pickle(self, filename=None):
@@ -435,3 +695,18 @@ class MapData:
             rospy.loginfo("Map data saved to {}".format(fn[:-4]+'.mapdata'))
         except Exception as e:
             rospy.logerr("Error while saving map data: {}".format(e))
+
+    def save(self, path):
+        '''
+        Save the whole map data to a gzip compressed pickle file.
+        '''
+        with gzip.open(path, 'wb') as fh:
+            pickle.dump(self, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        '''
+        Load map data saved by MapData.save.
+        '''
+        with gzip.open(path, 'rb') as fh:
+            return pickle.load(fh)
@@ -15,12 +15,28 @@ class Way():
         self.id = id
         self.is_area = is_area
         self.nodes = nodes
-        self.tags = tags
+        self.tags = tags if tags is not None else dict()
         self.line = line
         self.in_out = in_out
 
         self.pcd_points = None
+        self.prepared_line = None
     
+    def __getstate__(self):
+        # Prepared geometries cannot be pickled, they are prepared again on demand.
+        state = self.__dict__.copy()
+        state['prepared_line'] = None
+        return state
+
+    def get_prepared_line(self):
+        '''
+        Prepared version of self.line, for repeated containment/intersection tests (e.g. MapData.query_ways).
+        '''
+        prepared_line = getattr(self, 'prepared_line', None)
+        if prepared_line is None or prepared_line.context is not self.line:
+            self.prepared_line = prep(self.line)
+        return self.prepared_line
+
     def is_road(self):
         if self.tags.get('highway', None) and not self.tags.get('highway', None) in FOOTWAY_VALUES:
             return True
@@ -46,7 +62,7 @@ class Way():
                 yv = yv.ravel()
                 points = MultiPoint(np.array([xv,yv]).T).geoms
         
-                points = self.mask_points(points,self.line)
+                points = filter(self.get_prepared_line().contains, points)
                 self.pcd_points = list(points)
                 self.pcd_points = np.array(list(LineString(self.pcd_points).xy)).T
             else:
@@ -66,9 +82,3 @@ class Way():
                 self.pcd_points = pcd_points
         
         return self.pcd_points
-    
-    def mask_points(self, points, polygon):
-        polygon = prep(polygon)
-        contains = lambda p: polygon.contains(p)
-
-        return filter(contains, points)
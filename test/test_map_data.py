@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+
+import numpy as np
+import shapely.geometry as geometry
+
+import map_data as md
+from way import Way
+
+
+class Node:
+    def __init__(self, id):
+        self.id = id
+
+
+def make_map_data():
+    # Two waypoints in UTM zone 33U, without the on-disk cache.
+    map_data = md.MapData([np.array([[500000.0, 5400000.0], [500100.0, 5400100.0]]), 33, 'U'], coords_type="array", cache_dir=None)
+    map_data.roads_list = [Way(id=1, is_area=True, nodes=[Node(1), Node(2)], tags={'highway': 'primary'},
+                               line=geometry.LineString([(0, 0), (100, 0)]).buffer(3.5))]
+    map_data.footways_list = [Way(id=2, is_area=True, nodes=[Node(3), Node(4)], tags={'highway': 'footway'},
+                                  line=geometry.LineString([(0, 50), (100, 50)]).buffer(1.5))]
+    map_data.barriers_list = [Way(id=3, is_area=True, nodes=[Node(5), Node(6), Node(7), Node(5)], tags={'barrier': 'wall'},
+                                  line=geometry.Polygon([(40, 20), (60, 20), (60, 30)]))]
+    return map_data
+
+
+class TestCombineWays(unittest.TestCase):
+    def setUp(self):
+        self.map_data = md.MapData.__new__(md.MapData)
+        self.map_data.ways = dict()
+
+    def add_way(self, id, node_ids, coords):
+        way = Way(id=id, nodes=[Node(i) for i in node_ids], tags={'way_' + str(id): 'yes'}, line=geometry.LineString(coords))
+        self.map_data.ways[id] = way
+
+    def test_self_touching_ring(self):
+        # Ring 1-2-3-4-2-5-1 passing twice through node 2, split into six ways.
+        positions = {1: (0, 0), 2: (2, 0), 3: (3, 1), 4: (3, -1), 5: (1, -2)}
+        ring = [1, 2, 3, 4, 2, 5, 1]
+        for i in range(len(ring) - 1):
+            self.add_way(10 + i, ring[i:i+2], [positions[ring[i]], positions[ring[i+1]]])
+
+        ids = self.map_data.combine_ways(list(range(10, 16)))
+
+        self.assertEqual(len(ids), 1)
+        way = self.map_data.ways[ids[0]]
+        self.assertTrue(way.is_area)
+        self.assertEqual(way.line.geom_type, 'Polygon')
+        self.assertEqual(len(way.nodes), 7)
+        self.assertEqual(way.nodes[0].id, way.nodes[-1].id)
+        self.assertEqual(len(way.tags), 6)
+
+    def test_reversed_chain(self):
+        self.add_way(1, [1, 2, 3], [(0, 0), (1, 0), (2, 0)])
+        self.add_way(2, [5, 4, 3], [(4, 0), (3, 0), (2, 0)])
+        self.add_way(3, [7, 8], [(10, 10), (11, 10)])
+
+        ids = self.map_data.combine_ways([1, 2, 3])
+
+        self.assertEqual(len(ids), 2)
+        way = self.map_data.ways[ids[0]]
+        self.assertFalse(way.is_area)
+        self.assertEqual([node.id for node in way.nodes], [1, 2, 3, 4, 5])
+        self.assertEqual(list(way.line.coords), [(0, 0), (1, 0), (2, 0), (3, 0), (4, 0)])
+        self.assertEqual(ids[1], 3)
+
+
+class TestWaysToGeometries(unittest.TestCase):
+    def test_mixed_areas_and_lines(self):
+        coords = np.array([[0, 0], [1, 0], [1, 1], [0, 0],
+                           [5, 5], [6, 6],
+                           [0, 0], [0, 2], [2, 2], [0, 0],
+                           [7, 7], [8, 7], [9, 8]], dtype=float)
+        lengths = np.array([4, 2, 4, 3])
+        is_area = np.array([True, False, True, False])
+
+        geometries = md.ways_to_geometries(coords, lengths, is_area)
+
+        self.assertEqual([g.geom_type for g in geometries], ['Polygon', 'LineString', 'Polygon', 'LineString'])
+        self.assertTrue(geometries[0].equals(geometry.Polygon([(0, 0), (1, 0), (1, 1)])))
+        self.assertEqual(list(geometries[1].coords), [(5, 5), (6, 6)])
+        self.assertTrue(geometries[2].equals(geometry.Polygon([(0, 0), (0, 2), (2, 2)])))
+        self.assertEqual(list(geometries[3].coords), [(7, 7), (8, 7), (9, 8)])
+
+
+class TestQueryWays(unittest.TestCase):
+    def setUp(self):
+        self.map_data = make_map_data()
+
+    def test_hits(self):
+        self.assertEqual([way.id for way in self.map_data.query_ways(geometry.Point(50, 1))], [1])
+        self.assertEqual([way.id for way in self.map_data.query_ways(geometry.Point(58, 22))], [3])
+        line = geometry.LineString([(10, -10), (10, 60)])
+        self.assertEqual(sorted(way.id for way in self.map_data.query_ways(line)), [1, 2])
+
+    def test_misses(self):
+        # Inside the bounding box of the barrier, but outside the triangle itself.
+        self.assertEqual(self.map_data.query_ways(geometry.Point(42, 28)), [])
+        self.assertEqual(self.map_data.query_ways(geometry.Point(500, 500)), [])
+
+
+class TestSaveLoad(unittest.TestCase):
+    def test_round_trip(self):
+        map_data = make_map_data()
+        map_data.query_ways(geometry.Point(50, 1))
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'map.mapdata.gz')
+            map_data.save(path)
+            loaded = md.MapData.load(path)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        for name in ['roads_list', 'footways_list', 'barriers_list']:
+            original = getattr(map_data, name)
+            restored = getattr(loaded, name)
+            self.assertEqual([way.id for way in restored], [way.id for way in original])
+            self.assertEqual([way.tags for way in restored], [way.tags for way in original])
+            for way, restored_way in zip(original, restored):
+                self.assertTrue(restored_way.line.equals(way.line))
+        self.assertIsNone(loaded.geom_index)
+        self.assertEqual([way.id for way in loaded.query_ways(geometry.Point(50, 1))], [1])
+
+
+if __name__ == '__main__':
+    unittest.main()